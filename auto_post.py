@@ -10,22 +10,33 @@
 """
 import os
 import re
-import json
 import hashlib
+import queue
+import sqlite3
 import tempfile
+import time
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing, contextmanager
 from pathlib import Path
 from datetime import datetime, timezone
-from typing import Dict, List, Tuple, Optional
+from typing import IO, Dict, Iterable, Iterator, List, Tuple, Optional
 
 import requests
 import gspread
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
+from requests_toolbelt.multipart.encoder import MultipartEncoder
 
 # Важно: импортируем file-to-file функцию
-from unique import uniquify_video_file
+from unique import uniquify_video_files, uniquify_video_stream, probe_video_file, reserve_fast_tmp
 
 load_dotenv()
 
@@ -46,6 +57,9 @@ TEST_RUN = str(os.getenv("TEST_RUN", "FALSE")).strip().upper() == "TRUE"
 ENABLE_UNIQUE = str(os.getenv("ENABLE_UNIQUE", "TRUE")).strip().upper() == "TRUE"
 UNIQUE_LOGO_PATH = os.getenv("UNIQUE_LOGO_PATH", "")
 UNIQUE_OVERLAY_TEXT = os.getenv("UNIQUE_OVERLAY_TEXT", "")
+# Кодирование ffmpeg прямо в HTTP-загрузку (chunked), без промежуточного файла для первой платформы
+STREAM_UPLOAD = str(os.getenv("STREAM_UPLOAD", "FALSE")).strip().upper() == "TRUE"
+STREAM_CHUNK_SIZE = 1024 * 1024
 
 _stale = os.getenv("PROCESSING_STALE_MINUTES", "10")
 PROCESSING_STALE_MINUTES = int(_stale) if (_stale and _stale.strip().isdigit()) else 10
@@ -53,6 +67,33 @@ PROCESSING_STALE_MINUTES = int(_stale) if (_stale and _stale.strip().isdigit())
 _upload_to = os.getenv("UPLOAD_TIMEOUT", "600")
 UPLOAD_TIMEOUT = int(_upload_to) if (_upload_to and _upload_to.strip().isdigit()) else 600
 
+# Скачивание с Drive: размер куска (MiB) и число параллельных Range-запросов
+_drive_chunk = os.getenv("DRIVE_CHUNK_MB", "16")
+DRIVE_CHUNK_SIZE = (int(_drive_chunk) if (_drive_chunk and _drive_chunk.strip().isdigit()) else 16) * 1024 * 1024
+_drive_workers = os.getenv("DRIVE_DOWNLOAD_WORKERS", "4")
+DRIVE_DOWNLOAD_WORKERS = max(1, int(_drive_workers)) if (_drive_workers and _drive_workers.strip().isdigit()) else 4
+DRIVE_RANGE_TIMEOUT = 60
+
+# Локальный кэш метадаты Drive (name/mimeType/size) между прогонами; пусто — кэш выключен
+DRIVE_META_CACHE = os.getenv("DRIVE_META_CACHE", "drive_meta.sqlite")
+DRIVE_META_TTL_SECONDS = 24 * 60 * 60
+
+# Сколько уникальных версий кодируется одним запуском ffmpeg (вход декодируется 1 раз на группу)
+_batch = os.getenv("UNIQUE_BATCH_SIZE", "4")
+UNIQUE_BATCH_SIZE = max(1, int(_batch)) if (_batch and _batch.strip().isdigit()) else 4
+
+# Сколько строк (постов) обрабатывается параллельно
+_row_cc = os.getenv("ROW_CONCURRENCY", "2")
+ROW_CONCURRENCY = max(1, int(_row_cc)) if (_row_cc and _row_cc.strip().isdigit()) else 2
+
+# Общий на все строки пул задач ffmpeg + upload: в пакетном режиме задача — группа UNIQUE_BATCH_SIZE user-ов, иначе — user
+_user_cc = os.getenv("USER_CONCURRENCY", "4")
+USER_CONCURRENCY = max(1, int(_user_cc)) if (_user_cc and _user_cc.strip().isdigit()) else 4
+
+# Каталог уникальных версий между прогонами (имя — по seed file_id+user); пусто — только tmp строки
+UNIQUE_CACHE_DIR = os.getenv("UNIQUE_CACHE_DIR", "")
+UNIQUE_CACHE_TTL_SECONDS = 24 * 60 * 60
+
 VIDEO_MIMETYPES = ("video/", "application/octet-stream")  # octet-stream — общий fallback
 
 # ===== POSTS columns =====
@@ -66,12 +107,33 @@ COL_RESULT = "result"
 COL_USERS = "users"
 PLATFORM_COLUMNS = ["instagram", "tiktok"]
 
+_FILE_ID_RE = re.compile(r"[A-Za-z0-9_-]{10,}")
+_FILE_PATH_RE = re.compile(r"/file/d/([A-Za-z0-9_-]+)")
+_ID_QS_RE = re.compile(r"[?&]id=([A-Za-z0-9_-]+)")
+_SAFE_RE = re.compile(r"[^A-Za-z0-9._-]+")
+
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive.readonly",
 ]
 
 
+def _make_http_session() -> requests.Session:
+    """
+    Общая сессия: keep-alive и пул соединений переиспользуются между загрузками/скачиваниями.
+    Retry по умолчанию повторяет только идемпотентные методы (GET Range-кусков с Drive);
+    POST в upload-post.com не повторяется — потоковое тело нельзя переотправить, а повтор может задублировать пост.
+    """
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry)
+    session.mount("https://", adapter)
+    return session
+
+
+SESSION = _make_http_session()
+
+
 def now_iso() -> str:
     return datetime.now(timezone.utc).astimezone().isoformat(timespec="seconds")
 
@@ -80,13 +142,9 @@ def is_true(v) -> bool:
     return (v is True) or (isinstance(v, str) and v.strip().upper() == "TRUE")
 
 
-def normalize_headers(d: dict) -> dict:
-    return {str(k).strip().lower(): v for k, v in d.items()}
-
-
 def safe_filename(s: str) -> str:
     """Безопасное имя файла: убирает пробелы, слэши, эмодзи и т.п."""
-    s = re.sub(r"[^A-Za-z0-9._-]+", "_", (s or "").strip())
+    s = _SAFE_RE.sub("_", (s or "").strip())
     return (s[:80] or "user")
 
 
@@ -94,12 +152,12 @@ def drive_url_to_file_id(value: str) -> str:
     if not value:
         return ""
     value = value.strip()
-    if "drive.google.com" not in value and re.fullmatch(r"[A-Za-z0-9_-]{10,}", value):
+    if "drive.google.com" not in value and _FILE_ID_RE.fullmatch(value):
         return value
-    m = re.search(r"/file/d/([A-Za-z0-9_-]+)", value)
+    m = _FILE_PATH_RE.search(value)
     if m:
         return m.group(1)
-    m = re.search(r"[?&]id=([A-Za-z0-9_-]+)", value)
+    m = _ID_QS_RE.search(value)
     if m:
         return m.group(1)
     return ""
@@ -112,7 +170,7 @@ def load_creds():
     if os.path.exists(SERVICE_ACCOUNT_JSON):
         return Credentials.from_service_account_file(SERVICE_ACCOUNT_JSON, scopes=SCOPES)
 
-    return Credentials.from_service_account_info(json.loads(SERVICE_ACCOUNT_JSON), scopes=SCOPES)
+    return Credentials.from_service_account_info(orjson.loads(SERVICE_ACCOUNT_JSON), scopes=SCOPES)
 
 
 def ensure_history_header(ws_history):
@@ -131,10 +189,24 @@ def ensure_history_header(ws_history):
     )
 
 
-def read_setup_destinations(ws_setup) -> List[dict]:
-    """Возвращает список {user, platform}. Группировка по user — в main."""
-    # Читаем все значения, затем обрабатываем только первые 3 столбца
-    all_values = ws_setup.get_all_values()
+def read_sheet_values(sh, sheet_names: List[str]) -> List[List[list]]:
+    """
+    Все значения нескольких листов за один HTTP-запрос (values:batchGet), в порядке sheet_names.
+    API не возвращает пустые ячейки в конце строки — строки дополняются до общей ширины, как в get_all_values.
+    """
+    ranges = [gspread.utils.absolute_range_name(name) for name in sheet_names]
+    resp = sh.values_batch_get(ranges)
+    value_ranges = resp.get("valueRanges", [])
+    result: List[List[list]] = []
+    for i in range(len(sheet_names)):
+        values = value_ranges[i].get("values", []) if i < len(value_ranges) else []
+        result.append(gspread.utils.fill_gaps(values) if values else [])
+    return result
+
+
+def read_setup_destinations(all_values: List[list]) -> List[dict]:
+    """Возвращает список {user, platform} по значениям листа setup. Группировка по user — в main."""
+    # Обрабатываем только первые 3 столбца
     if not all_values or len(all_values) < 2:
         return []
     
@@ -191,60 +263,296 @@ def is_processing_stale(result_val: str) -> bool:
 def make_unique_seed(file_id: str, user: str) -> int:
     """Детерминированный seed: стабилен по file_id+user, не зависит от номера строки."""
     s = f"{file_id}:{user}"
-    return int(hashlib.sha256(s.encode()).hexdigest()[:12], 16)
+    return int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big")
+
+
+def unique_output_name(seed: int) -> str:
+    """Имя уникальной версии по seed: одинаковый seed -> тот же файл (повторный прогон не кодирует заново)."""
+    return f"unique_{seed:016x}.mp4"
+
+
+def prune_unique_cache() -> None:
+    """Удаляет из UNIQUE_CACHE_DIR версии старше UNIQUE_CACHE_TTL_SECONDS (в т.ч. недописанные .part)."""
+    if not UNIQUE_CACHE_DIR:
+        return
+    cache_dir = Path(UNIQUE_CACHE_DIR)
+    if not cache_dir.is_dir():
+        return
+    deadline = time.time() - UNIQUE_CACHE_TTL_SECONDS
+    for p in cache_dir.glob("unique_*.mp4"):
+        try:
+            if p.stat().st_mtime < deadline:
+                p.unlink()
+        except OSError:
+            pass
 
 
-def download_drive_file_to_path(drive_service, file_id: str, dst_path: Path) -> str:
+class _BackgroundWriter:
     """
-    Скачивает файл из Drive сразу на диск (dst_path). Возвращает filename из метадаты.
-    Проверяет mimeType на "похоже на видео".
+    Файл-обёртка для MediaIoBaseDownload: write() только кладёт кусок в очередь,
+    на диск пишет отдельный поток — запись куска идёт параллельно скачиванию следующего.
     """
-    meta = drive_service.files().get(fileId=file_id, fields="name,mimeType,size").execute()
-    filename = meta.get("name", "video.mp4")
+
+    def __init__(self, f: IO[bytes], maxsize: int = 4):
+        self._f = f
+        self._queue: "queue.Queue[Optional[bytes]]" = queue.Queue(maxsize=maxsize)
+        self._error: Optional[Exception] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            buf = self._queue.get()
+            if buf is None:
+                return
+            # после ошибки очередь всё равно разбирается, чтобы write() не завис на полной очереди
+            if self._error is None:
+                try:
+                    self._f.write(buf)
+                except Exception as e:
+                    self._error = e
+
+    def write(self, buf: bytes) -> int:
+        if self._error is not None:
+            raise self._error
+        self._queue.put(buf)
+        return len(buf)
+
+    def close(self) -> None:
+        """Дожидается записи всех кусков; ошибка записи поднимается здесь."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+def _download_drive_ranges(url: str, creds, size: int, dst_path: Path) -> None:
+    """
+    Параллельное скачивание Range-запросами: каждый кусок пишется в свой offset.
+    Файл заранее расширяется до size, поэтому порядок завершения кусков не важен.
+    """
+    if not creds.valid:
+        creds.refresh(GoogleAuthRequest())
+    auth = {"Authorization": f"Bearer {creds.token}"}
+
+    with open(dst_path, "wb") as f:
+        f.truncate(size)
+
+    def fetch(start: int) -> None:
+        end = min(start + DRIVE_CHUNK_SIZE, size) - 1
+        headers = {**auth, "Range": f"bytes={start}-{end}"}
+        with SESSION.get(url, headers=headers, stream=True, timeout=DRIVE_RANGE_TIMEOUT) as resp:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                raise RuntimeError(f"Drive ignored Range request (HTTP {resp.status_code})")
+            # size может быть из кэша метадаты: если файл заменили, полный размер в Content-Range другой
+            total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+            if total != str(size):
+                raise RuntimeError(f"Drive file size changed: expected {size}, Content-Range total {total or '?'}")
+            written = 0
+            with open(dst_path, "r+b") as f:
+                f.seek(start)
+                for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+                    written += len(chunk)
+        if written != end - start + 1:
+            raise RuntimeError(f"Drive range {start}-{end} truncated: got {written} bytes")
+
+    with ThreadPoolExecutor(max_workers=DRIVE_DOWNLOAD_WORKERS) as pool:
+        # list() — чтобы пробросить исключение из любого куска
+        list(pool.map(fetch, range(0, size, DRIVE_CHUNK_SIZE)))
+
+
+def _meta_cache_connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DRIVE_META_CACHE, timeout=10)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS meta(file_id TEXT PRIMARY KEY, name TEXT, mime TEXT, size INT, ts INT)"
+    )
+    return conn
+
+
+def _meta_cache_get(file_id: str) -> Optional[dict]:
+    if not DRIVE_META_CACHE:
+        return None
+    try:
+        with closing(_meta_cache_connect()) as conn:
+            row = conn.execute("SELECT name, mime, size, ts FROM meta WHERE file_id = ?", (file_id,)).fetchone()
+    except sqlite3.Error:
+        return None
+    if not row or time.time() - row[3] >= DRIVE_META_TTL_SECONDS:
+        return None
+    return {"name": row[0], "mimeType": row[1], "size": row[2]}
+
+
+def _meta_cache_put(file_id: str, meta: dict) -> None:
+    if not DRIVE_META_CACHE:
+        return
+    try:
+        with closing(_meta_cache_connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO meta(file_id, name, mime, size, ts) VALUES (?, ?, ?, ?, ?)",
+                (file_id, meta.get("name"), meta.get("mimeType"), meta.get("size"), int(time.time())),
+            )
+    except sqlite3.Error:
+        pass
+
+
+def _meta_cache_invalidate(file_id: str) -> None:
+    if not DRIVE_META_CACHE:
+        return
+    try:
+        with closing(_meta_cache_connect()) as conn, conn:
+            conn.execute("DELETE FROM meta WHERE file_id = ?", (file_id,))
+    except sqlite3.Error:
+        pass
+
+
+def get_drive_file_meta(drive_service, file_id: str) -> dict:
+    """
+    Метадата файла Drive (name, mimeType, size). Проверяет mimeType на "похоже на видео".
+    Свежая (< DRIVE_META_TTL_SECONDS) запись из локального sqlite-кэша избавляет от запроса files().get.
+    """
+    meta = _meta_cache_get(file_id)
+    if meta is None:
+        meta = drive_service.files().get(fileId=file_id, fields="name,mimeType,size").execute()
+        _meta_cache_put(file_id, meta)
     mime = (meta.get("mimeType") or "").lower()
     if mime and not any(mime.startswith(p) for p in VIDEO_MIMETYPES):
         raise ValueError(f"Drive file is not a video (mimeType={mime}). Expected video/* or application/octet-stream.")
+    return meta
 
-    request = drive_service.files().get_media(fileId=file_id)
+
+def download_drive_file_to_path(drive_service, file_id: str, dst_path: Path, creds=None, meta: Optional[dict] = None) -> str:
+    """
+    Скачивает файл из Drive сразу на диск (dst_path). Возвращает filename из метадаты.
+    meta — результат get_drive_file_meta (если уже получен), иначе запрашивается здесь.
+    Если известны creds и размер файла больше одного куска — качает параллельными Range-запросами,
+    иначе последовательно через MediaIoBaseDownload крупными кусками (запись на диск — в фоне, _BackgroundWriter).
+    """
+    if meta is None:
+        meta = get_drive_file_meta(drive_service, file_id)
+    filename = meta.get("name", "video.mp4")
+
+    size = int(meta.get("size") or 0)
 
     dst_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(dst_path, "wb") as f:
-        downloader = MediaIoBaseDownload(f, request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
+    try:
+        request = drive_service.files().get_media(fileId=file_id)
+        if creds is not None and DRIVE_DOWNLOAD_WORKERS > 1 and size > DRIVE_CHUNK_SIZE:
+            _download_drive_ranges(request.uri, creds, size, dst_path)
+            return filename
+
+        with open(dst_path, "wb") as f:
+            writer = _BackgroundWriter(f)
+            try:
+                downloader = MediaIoBaseDownload(writer, request, chunksize=DRIVE_CHUNK_SIZE)
+                done = False
+                while not done:
+                    _, done = downloader.next_chunk()
+            finally:
+                writer.close()
+    except Exception:
+        # метадата могла устареть (файл заменён/удалён) — в следующий раз спросим Drive заново
+        _meta_cache_invalidate(file_id)
+        raise
 
     return filename
 
 
-def upload_post_video_path(video_path: Path, filename: str, user: str, caption: str, platform: str) -> dict:
-    """
-    Загружает видео как file-stream (не читая весь файл в RAM).
-    """
-    headers = {"Authorization": f"Apikey {UPLOAD_POST_API_KEY}"}
+def _upload_form_fields(filename: str, user: str, caption: str, platform: str) -> List[Tuple[str, str]]:
     title = caption.strip() if caption else os.path.splitext(filename)[0] or "Untitled"
-
-    multipart_data = [
+    fields = [
         ("user", user),
         ("platform[]", platform.strip().lower()),
         ("title", title),
     ]
     if caption:
-        multipart_data.append(("description", caption))
+        fields.append(("description", caption))
+    return fields
+
+
+def _parse_upload_response(resp: requests.Response) -> dict:
+    resp.raise_for_status()
+    ct = resp.headers.get("content-type", "")
+    return resp.json() if ct.startswith("application/json") else {"raw": resp.text}
+
 
+def format_upload_result(result) -> str:
+    """Ответ API для history: orjson, а что он не сериализует (int шире 64 бит и т.п.) — через str()."""
+    try:
+        return orjson.dumps(result).decode()[:45000]
+    except orjson.JSONEncodeError:
+        return str(result)[:45000]
+
+
+def upload_post_video_path(video_path: Path, filename: str, user: str, caption: str, platform: str) -> dict:
+    """
+    Загружает видео как file-stream (не читая весь файл в RAM).
+    MultipartEncoder отдаёт тело по мере чтения с диска — RAM остаётся O(chunk).
+    """
     with open(video_path, "rb") as f:
-        files = {"video": (filename, f, "video/mp4")}
-        resp = requests.post(
+        fields = _upload_form_fields(filename, user, caption, platform)
+        fields.append(("video", (filename, f, "video/mp4")))
+
+        encoder = MultipartEncoder(fields=fields)
+        headers = {
+            "Authorization": f"Apikey {UPLOAD_POST_API_KEY}",
+            "Content-Type": encoder.content_type,
+        }
+        resp = SESSION.post(
             UPLOAD_POST_ENDPOINT,
             headers=headers,
-            data=multipart_data,
-            files=files,
+            data=encoder,
             timeout=UPLOAD_TIMEOUT,
         )
 
-    resp.raise_for_status()
-    ct = resp.headers.get("content-type", "")
-    return resp.json() if ct.startswith("application/json") else {"raw": resp.text}
+    return _parse_upload_response(resp)
+
+
+def _iter_multipart_stream(fields: List[Tuple[str, str]], filename: str, stream: IO[bytes], boundary: str):
+    """
+    multipart/form-data по кускам: поля формы, затем видео из stream до EOF.
+    Закрывающий boundary уходит только после EOF без ошибки: если stream.read() поднял исключение
+    (ffmpeg упал), тело остаётся незавершённым и сервер не получит обрезанное видео как целое.
+    """
+    for name, value in fields:
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n"
+        ).encode("utf-8")
+    quoted = filename.replace('"', "%22").replace("\r", "").replace("\n", "")
+    yield (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="video"; filename="{quoted}"\r\n'
+        "Content-Type: video/mp4\r\n\r\n"
+    ).encode("utf-8")
+    while True:
+        chunk = stream.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+    yield f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+
+def upload_post_video_stream(stream: IO[bytes], filename: str, user: str, caption: str, platform: str) -> dict:
+    """
+    Загружает видео из потока неизвестной длины (stdout ffmpeg) через chunked transfer-encoding:
+    байты уходят в сеть по мере кодирования.
+    """
+    boundary = uuid.uuid4().hex
+    fields = _upload_form_fields(filename, user, caption, platform)
+    headers = {
+        "Authorization": f"Apikey {UPLOAD_POST_API_KEY}",
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+    }
+    resp = SESSION.post(
+        UPLOAD_POST_ENDPOINT,
+        headers=headers,
+        data=_iter_multipart_stream(fields, filename, stream, boundary),
+        timeout=UPLOAD_TIMEOUT,
+    )
+    return _parse_upload_response(resp)
 
 
 def main():
@@ -270,14 +578,15 @@ def main():
 
     # print("STEP 5: open worksheets", flush=True)
     ws_posts = sh.worksheet(SHEET_POSTS)
-    ws_setup = sh.worksheet(SHEET_SETUP)
     ws_history = sh.worksheet(SHEET_HISTORY)
 
     # print("STEP 6: ensure history header", flush=True)
     ensure_history_header(ws_history)
 
-    # print("STEP 7: read setup destinations", flush=True)
-    dests = read_setup_destinations(ws_setup)
+    # print("STEP 7: read posts + setup (one request)", flush=True)
+    posts_values, setup_values = read_sheet_values(sh, [SHEET_POSTS, SHEET_SETUP])
+
+    dests = read_setup_destinations(setup_values)
     if not dests:
         print("SETUP ERROR: no destinations. Check setup sheet: users + platform checkboxes.", flush=True)
         return
@@ -286,32 +595,53 @@ def main():
     total_targets = sum(len(v) for v in by_user.values())
     print(f"Destinations users={len(by_user)} total_targets={total_targets}", flush=True)
 
-    # print("STEP 8: build drive service", flush=True)
-    drive_service = build("drive", "v3", credentials=creds)
-
-    # print("STEP 9: read posts rows", flush=True)
-    posts = ws_posts.get_all_records()
-    if not posts:
+    # print("STEP 9: parse posts rows", flush=True)
+    if len(posts_values) < 2:
         print("No posts rows.", flush=True)
         return
 
-    headers = ws_posts.row_values(1)
-    header_to_col = {str(h).strip().lower(): i + 1 for i, h in enumerate(headers)}
+    header_keys = [str(h).strip().lower() for h in posts_values[0]]
+    header_to_col = {h: i + 1 for i, h in enumerate(header_keys)}
+    posts = [dict(zip(header_keys, row + [""] * (len(header_keys) - len(row)))) for row in posts_values[1:]]
+
+    # gspread-клиент не потокобезопасен — все записи в листы идут под одним локом
+    sheets_lock = threading.Lock()
+    # Отложенные записи в posts: {(row, col): value}; уходят одним batch_update во flush_cells
+    pending_cells: Dict[Tuple[int, int], object] = {}
 
     def set_cell(row_idx_1based: int, col_name: str, value):
         col = header_to_col.get(str(col_name).strip().lower())
         if col:
-            ws_posts.update_cell(row_idx_1based, col, value)
+            with sheets_lock:
+                pending_cells[(row_idx_1based, col)] = value
+
+    def flush_cells():
+        with sheets_lock:
+            if not pending_cells:
+                return
+            data = [
+                {"range": gspread.utils.rowcol_to_a1(r, c), "values": [[v]]}
+                for (r, c), v in pending_cells.items()
+            ]
+            # USER_ENTERED — как у update_cell, чтобы "FALSE" оставался чекбоксом
+            ws_posts.batch_update(data, value_input_option="USER_ENTERED")
+            pending_cells.clear()
+
+    def append_history(rows: List[list]):
+        if rows:
+            with sheets_lock:
+                ws_history.append_rows(rows)
 
-    posts_done = 0
     logo_path = Path(UNIQUE_LOGO_PATH) if UNIQUE_LOGO_PATH and Path(UNIQUE_LOGO_PATH).is_file() else None
+    prune_unique_cache()
 
-    for row_idx, row in enumerate(posts, start=2):
-        if MAX_POSTS_PER_RUN is not None and posts_done >= MAX_POSTS_PER_RUN:
+    # Отбор строк — локально по уже прочитанным данным; лимит MAX_POSTS_PER_RUN применяется до запуска
+    selected: List[Tuple[int, dict]] = []
+    for row_idx, rn in enumerate(posts, start=2):
+        if MAX_POSTS_PER_RUN is not None and len(selected) >= MAX_POSTS_PER_RUN:
             # print(f"STEP 10: MAX_POSTS_PER_RUN reached ({MAX_POSTS_PER_RUN}), stopping", flush=True)
             break
 
-        rn = normalize_headers(row)
         if not is_true(rn.get(COL_TO_POST)):
             continue
 
@@ -323,6 +653,50 @@ def main():
         if status_val == "processing" and not is_processing_stale(result_val):
             continue
 
+        selected.append((row_idx, rn))
+
+    # httplib2 внутри drive_service не потокобезопасен — свой клиент Drive на каждый поток строк
+    drive_local = threading.local()
+
+    def get_drive_service():
+        if getattr(drive_local, "service", None) is None:
+            drive_local.service = build("drive", "v3", credentials=creds)
+        return drive_local.service
+
+    # Потоки фильтров ffmpeg: ядра делятся между одновременно работающими ffmpeg, чтобы не было переподписки
+    batch_mode = ENABLE_UNIQUE and not TEST_RUN and not STREAM_UPLOAD
+    ffmpeg_per_row = -(-len(by_user) // UNIQUE_BATCH_SIZE) if batch_mode else len(by_user)
+    parallel_ffmpeg = max(1, min(USER_CONCURRENCY, ROW_CONCURRENCY * ffmpeg_per_row))
+    ffmpeg_threads = max(2, (os.cpu_count() or 1) // parallel_ffmpeg)
+
+    # Версии в UNIQUE_CACHE_DIR общие для строк с одним file_id: seed кодируется под своим локом,
+    # а удаляется, только когда его не держит ни одна строка
+    cache_lock = threading.Lock()
+    encode_locks: Dict[int, threading.Lock] = {}
+    seed_refs: Dict[int, int] = {}
+
+    @contextmanager
+    def hold_cached(seeds: Iterable[int]) -> Iterator[None]:
+        seeds = list(seeds)
+        with cache_lock:
+            for seed in seeds:
+                seed_refs[seed] = seed_refs.get(seed, 0) + 1
+        try:
+            yield
+        finally:
+            with cache_lock:
+                for seed in seeds:
+                    seed_refs[seed] -= 1
+                    if not seed_refs[seed]:
+                        del seed_refs[seed]
+
+    def drop_cached(cache_dir: Path, seeds: Iterable[int]) -> None:
+        with cache_lock:
+            for seed in seeds:
+                if seed not in seed_refs:
+                    (cache_dir / unique_output_name(seed)).unlink(missing_ok=True)
+
+    def process_row(row_idx: int, rn: dict) -> None:
         caption = str(rn.get(COL_CAPTION) or "").strip()
         drive_link = str(rn.get(COL_DRIVE_FILE_LINK) or "").strip()
         file_id = drive_url_to_file_id(drive_link)
@@ -333,104 +707,255 @@ def main():
             set_cell(row_idx, COL_STATUS, "failed")
             set_cell(row_idx, COL_RESULT, "Could not extract Drive file_id from drive_file_link")
             set_cell(row_idx, COL_TO_POST, "FALSE")
-            ws_history.append_row([now_iso(), row_idx, "", "", caption, "", "failed",
-                                   "Could not extract Drive file_id from drive_file_link"])
-            posts_done += 1
-            continue
+            flush_cells()
+            append_history([[now_iso(), row_idx, "", "", caption, "", "failed",
+                             "Could not extract Drive file_id from drive_file_link"]])
+            return
 
-        set_cell(row_idx, COL_STATUS, "processing")
-        set_cell(row_idx, COL_RESULT, f"processing since {now_iso()}")
+        def fail_download(e: Exception):
+            err = f"Drive download failed: {e}"
+            set_cell(row_idx, COL_STATUS, "failed")
+            set_cell(row_idx, COL_RESULT, err[:45000])
+            set_cell(row_idx, COL_TO_POST, "FALSE")
+            flush_cells()
+            append_history([[now_iso(), row_idx, "", "", caption, file_id, "failed", err[:45000]]])
 
         ok = 0
         fail = 0
         results_compact: List[str] = []
-
-        with tempfile.TemporaryDirectory(prefix="auto_post_") as td:
+        history_rows: List[list] = []
+
+        meta: dict = {}
+        if not TEST_RUN:
+            try:
+                meta = get_drive_file_meta(get_drive_service(), file_id)
+            except Exception as e:
+                fail_download(e)
+                return
+
+        # Версии user-ов по seed: при UNIQUE_CACHE_DIR переживают прогон, и повтор строки
+        # (partial/failed/stale) не кодирует заново уже готовые
+        seeds = {user: make_unique_seed(file_id, user) for user in by_user}
+        cache_dir = Path(UNIQUE_CACHE_DIR) if (UNIQUE_CACHE_DIR and batch_mode) else None
+
+        # Вход + уникальные версии на user-ов: на tmpfs, только если там хватает места.
+        # Место резервируется до конца строки — параллельные строки не рассчитывают на одно и то же свободное место
+        size = int(meta.get("size") or 0)
+        copies = 1 + (len(by_user) if (ENABLE_UNIQUE and not TEST_RUN and cache_dir is None) else 0)
+
+        with hold_cached(seeds.values() if cache_dir is not None else ()), \
+                reserve_fast_tmp(copies * size) as tmp_dir, \
+                tempfile.TemporaryDirectory(prefix="auto_post_", dir=tmp_dir) as td:
             td_path = Path(td)
+            out_dir = cache_dir or td_path
+            cached = cache_dir is not None and all(
+                (cache_dir / unique_output_name(seed)).is_file() for seed in seeds.values()
+            )
 
             if TEST_RUN:
                 input_path = td_path / "TEST_RUN.mp4"
                 input_path.write_bytes(b"")
                 filename = "TEST_RUN.mp4"
                 # print("STEP 12: TEST_RUN enabled (no Drive download)", flush=True)
+            elif cached:
+                # Все версии уже в кэше — вход не нужен
+                input_path = td_path / "input.mp4"
+                filename = meta.get("name", "video.mp4")
+                print(f"Cached: {filename}", flush=True)
             else:
                 input_path = td_path / "input.mp4"
                 # print(f"STEP 12: download Drive -> {input_path}", flush=True)
                 try:
-                    filename = download_drive_file_to_path(drive_service, file_id, input_path)
+                    filename = download_drive_file_to_path(get_drive_service(), file_id, input_path,
+                                                           creds=creds, meta=meta)
                     print(f"Downloaded: {filename}", flush=True)
                 except Exception as e:
-                    err = f"Drive download failed: {e}"
-                    set_cell(row_idx, COL_STATUS, "failed")
-                    set_cell(row_idx, COL_RESULT, err[:45000])
-                    set_cell(row_idx, COL_TO_POST, "FALSE")
-                    ws_history.append_row([now_iso(), row_idx, "", "", caption, file_id, "failed", err[:45000]])
-                    posts_done += 1
-                    continue
+                    fail_download(e)
+                    return
 
             base = os.path.splitext(filename)[0]
 
-            for user, platforms in by_user.items():
+            # ffprobe входного видео — 1 раз на строку, а не на каждого user-а
+            video_info = probe_video_file(input_path) if (ENABLE_UNIQUE and not TEST_RUN and not cached) else {}
+
+            def process_user(user: str, platforms: List[str], encoded_path: Optional[Path] = None,
+                             encode_error: Optional[Exception] = None) -> Tuple[int, int, List[str], List[list]]:
+                """
+                Уникализация + загрузка для одного user. Возвращает (ok, fail, compact, history_rows).
+                encoded_path/encode_error — результат общего ffmpeg группы (process_group), если версия уже закодирована.
+                """
+                u_ok = 0
+                u_fail = 0
+                compact: List[str] = []
+                history: List[list] = []
+
                 user_safe = safe_filename(user)
                 out_filename = f"{base}_{user_safe}.mp4"
 
+                def upload_platform(platform: str, video) -> Tuple[bool, list]:
+                    """Загрузка на одну платформу (video — путь или поток). Возвращает (ok, history_row)."""
+                    try:
+                        if TEST_RUN:
+                            result = {"test_run": True, "user": user, "platform": platform}
+                        elif isinstance(video, Path):
+                            # print(f"STEP 14: upload user={user} platform={platform}", flush=True)
+                            result = upload_post_video_path(
+                                video_path=video,
+                                filename=out_filename,
+                                user=user,
+                                caption=caption,
+                                platform=platform,
+                            )
+                        else:
+                            result = upload_post_video_stream(
+                                stream=video,
+                                filename=out_filename,
+                                user=user,
+                                caption=caption,
+                                platform=platform,
+                            )
+                    except Exception as e:
+                        err = str(e)[:45000]
+                        return False, [now_iso(), row_idx, user, platform, caption, file_id, "failed", err]
+                    # Сериализация — после загрузки: ошибка форматирования не должна превращать пост в failed
+                    rtxt = format_upload_result(result)
+                    return True, [now_iso(), row_idx, user, platform, caption, file_id, "posted", rtxt]
+
+                outcomes: List[Tuple[str, bool, list]] = []
                 try:
-                    if TEST_RUN or not ENABLE_UNIQUE:
+                    pending = list(platforms)
+                    if encode_error is not None:
+                        raise encode_error
+                    if encoded_path is not None:
+                        out_path = encoded_path
+                    elif TEST_RUN or not ENABLE_UNIQUE:
                         out_path = input_path
                         # if not ENABLE_UNIQUE:
                         #     print(f"STEP 13: unique disabled -> user={user}", flush=True)
+                    elif STREAM_UPLOAD:
+                        # Первая платформа получает видео прямо из stdout ffmpeg;
+                        # для остальных тот же поток параллельно пишется в файл (tee)
+                        out_path = td_path / unique_output_name(seeds[user])
+                        with uniquify_video_stream(
+                            input_path=input_path,
+                            output_path=out_path if len(platforms) > 1 else None,
+                            seed=seeds[user],
+                            logo_path=logo_path,
+                            overlay_text=UNIQUE_OVERLAY_TEXT or None,
+                            audio_present=video_info.get("has_audio"),
+                            threads=ffmpeg_threads,
+                        ) as stream:
+                            outcomes.append((pending[0], *upload_platform(pending[0], stream)))
+                        pending = pending[1:]
+
+                    # Платформы одного user-а — независимые POST-ы одного и того же файла
+                    if pending:
+                        with ThreadPoolExecutor(max_workers=len(pending)) as platform_pool:
+                            platform_futures = [(platform, platform_pool.submit(upload_platform, platform, out_path))
+                                                for platform in pending]
+                            for platform, fut in platform_futures:
+                                outcomes.append((platform, *fut.result()))
+
+                except Exception as e:
+                    # Уже состоявшиеся загрузки (первая платформа в STREAM_UPLOAD) сохраняют свой итог
+                    err = str(e)[:45000]
+                    done = {platform for platform, _, _ in outcomes}
+                    outcomes += [
+                        (platform, False, [now_iso(), row_idx, user, platform, caption, file_id, "failed", err])
+                        for platform in platforms if platform not in done
+                    ]
+
+                for platform, posted, hrow in outcomes:
+                    if posted:
+                        u_ok += 1
+                        compact.append(f"{platform}:{user}=ok")
                     else:
-                        out_path = td_path / f"unique_{user_safe}.mp4"
-                        seed = make_unique_seed(file_id, user)
-                        # print(f"STEP 13: uniquify user={user} seed={seed}", flush=True)
-                        uniquify_video_file(
+                        u_fail += 1
+                        compact.append(f"{platform}:{user}=fail")
+                    history.append(hrow)
+
+                return u_ok, u_fail, compact, history
+
+            def process_group(group: List[Tuple[str, List[str]]]) -> List[Tuple[int, int, List[str], List[list]]]:
+                """Версии группы user-ов — одним ffmpeg (вход декодируется 1 раз), затем загрузки user-ов параллельно."""
+                out_paths = [out_dir / unique_output_name(seeds[user]) for user, _ in group]
+                encode_error: Optional[Exception] = None
+                locks: List[threading.Lock] = []
+                if cache_dir is not None:
+                    # Сортировка — одинаковый порядок захвата во всех строках, без взаимоблокировки
+                    with cache_lock:
+                        locks = [encode_locks.setdefault(seed, threading.Lock())
+                                 for seed in sorted({seeds[user] for user, _ in group})]
+                try:
+                    with ExitStack() as stack:
+                        for lock in locks:
+                            stack.enter_context(lock)
+                        # Уже готовые версии (skip_if_exists) не кодируются; все готовы — ffmpeg не запускается
+                        uniquify_video_files(
                             input_path=input_path,
-                            output_path=out_path,
-                            seed=seed,
-                            skip_if_exists=False,
+                            jobs=[(out, seeds[user]) for out, (user, _) in zip(out_paths, group)],
                             logo_path=logo_path,
                             overlay_text=UNIQUE_OVERLAY_TEXT or None,
+                            audio_present=video_info.get("has_audio"),
+                            threads=ffmpeg_threads,
                         )
+                except Exception as e:
+                    encode_error = e
+
+                with ThreadPoolExecutor(max_workers=len(group)) as group_pool:
+                    group_futures = [
+                        group_pool.submit(process_user, user, platforms, out, encode_error)
+                        for out, (user, platforms) in zip(out_paths, group)
+                    ]
+                    return [fut.result() for fut in group_futures]
+
+            users = list(by_user.items())
+            if batch_mode:
+                groups = [users[i:i + UNIQUE_BATCH_SIZE] for i in range(0, len(users), UNIQUE_BATCH_SIZE)]
+                group_futures = [user_pool.submit(process_group, group) for group in groups]
+                user_results = [res for fut in group_futures for res in fut.result()]
+            else:
+                user_futures = [user_pool.submit(process_user, user, platforms) for user, platforms in users]
+                user_results = [fut.result() for fut in user_futures]
 
-                    for platform in platforms:
-                        try:
-                            if TEST_RUN:
-                                result = {"test_run": True, "user": user, "platform": platform}
-                            else:
-                                # print(f"STEP 14: upload user={user} platform={platform}", flush=True)
-                                result = upload_post_video_path(
-                                    video_path=out_path,
-                                    filename=out_filename,
-                                    user=user,
-                                    caption=caption,
-                                    platform=platform,
-                                )
-                            ok += 1
-                            rtxt = json.dumps(result, ensure_ascii=False)[:45000]
-                            ws_history.append_row([now_iso(), row_idx, user, platform, caption, file_id, "posted", rtxt])
-                            results_compact.append(f"{platform}:{user}=ok")
-                        except Exception as e:
-                            fail += 1
-                            err = str(e)[:45000]
-                            ws_history.append_row([now_iso(), row_idx, user, platform, caption, file_id, "failed", err])
-                            results_compact.append(f"{platform}:{user}=fail")
+            # Собираем в порядке users из setup, чтобы history/result были детерминированными
+            for u_ok, u_fail, compact, rows in user_results:
+                ok += u_ok
+                fail += u_fail
+                results_compact.extend(compact)
+                history_rows.extend(rows)
 
-                except Exception as e:
-                    err = str(e)[:45000]
-                    for platform in platforms:
-                        fail += 1
-                        ws_history.append_row([now_iso(), row_idx, user, platform, caption, file_id, "failed", err])
-                        results_compact.append(f"{platform}:{user}=fail")
+        append_history(history_rows)
 
         final_status = "posted" if (ok > 0 and fail == 0) else ("partial" if ok > 0 else "failed")
         set_cell(row_idx, COL_STATUS, final_status)
         set_cell(row_idx, COL_RESULT, f"ok={ok} fail={fail} | " + ", ".join(results_compact))
         set_cell(row_idx, COL_TO_POST, "FALSE")
+        flush_cells()
+
+        # Пост опубликован везде — его версии больше не понадобятся (если их не держит другая строка)
+        if cache_dir is not None and final_status == "posted":
+            drop_cached(cache_dir, seeds.values())
 
-        posts_done += 1
         print(f"Row {row_idx} done: {final_status} (ok={ok}, fail={fail})", flush=True)
 
-    if posts_done == 0:
+    # Claim: все выбранные строки получают processing одним batch_update до начала обработки,
+    # а не парой записей в начале каждой строки. Метка защищает строки от параллельного прогона.
+    claimed_at = now_iso()
+    for row_idx, rn in selected:
+        if drive_url_to_file_id(str(rn.get(COL_DRIVE_FILE_LINK) or "").strip()):
+            set_cell(row_idx, COL_STATUS, "processing")
+            set_cell(row_idx, COL_RESULT, f"processing since {claimed_at}")
+    flush_cells()
+
+    # Строки обрабатываются параллельно; user-ы всех строк делят общий user_pool
+    with ThreadPoolExecutor(max_workers=USER_CONCURRENCY) as user_pool, \
+            ThreadPoolExecutor(max_workers=ROW_CONCURRENCY) as row_pool:
+        row_futures = [row_pool.submit(process_row, row_idx, rn) for row_idx, rn in selected]
+        for fut in row_futures:
+            fut.result()
+
+    if not selected:
         print("No rows to post (no to_post=TRUE or already processed).", flush=True)
 
 
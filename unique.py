@@ -2,11 +2,18 @@
 Уникализация видео — библиотека для создания уникальных версий одного видео.
 Использует ffmpeg для изменения скорости, цвета, резкости, аудио и т.д.
 """
+import json
+import os
 import random
+import shutil
 import subprocess
 import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import IO, Callable, Iterator, Optional, Tuple
 
 
 # ==================== ПАРАМЕТРЫ ====================
@@ -17,6 +24,8 @@ BRIGHTNESS_RANGE = (0.02, 0.06)
 CONTRAST_RANGE = (1.06, 1.12)
 SATURATION_RANGE = (1.03, 1.10)
 
+CROP_KEEP = 0.99  # доля кадра, остающаяся после кропа (смещение окна — из seed)
+
 SHARPEN_PROB = 0.8
 UNSHARP_RANGE = (0.8, 1.15)
 
@@ -39,9 +48,79 @@ AUDIO_PITCH_RANGE = (0.985, 1.015)
 
 USE_RUBBERBAND = True
 
+# Промежуточные файлы — на tmpfs (RAM), если он есть и в нём хватает места
+FAST_TMP = os.getenv("FAST_TMP", "/dev/shm")
+# Место в FAST_TMP, уже обещанное параллельным задачам (файлы ещё не дописаны), — см. reserve_fast_tmp
+_fast_tmp_lock = threading.Lock()
+_fast_tmp_reserved = 0
+
+# Фрагментированный mp4 — можно писать в pipe (moov в начале, без seek назад)
+PIPE_MOVFLAGS = "+frag_keyframe+empty_moov+default_base_moof"
+
+# Видеокодер: аппаратный (если есть и реально работает) -> libx264
+FORCE_SW_ENCODE = str(os.getenv("FORCE_SW_ENCODE", "0")).strip().upper() in ("1", "TRUE")
+HW_ENCODERS = ("h264_nvenc", "h264_qsv", "h264_videotoolbox")
+VIDEO_ENCODER_ARGS = {
+    "h264_nvenc": ["-c:v", "h264_nvenc", "-preset", "p4", "-rc", "vbr", "-cq", "23", "-b:v", "0"],
+    "h264_qsv": ["-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "23", "-pix_fmt", "nv12"],
+    "h264_videotoolbox": ["-c:v", "h264_videotoolbox", "-b:v", "6M"],
+    "libx264": ["-c:v", "libx264", "-preset", "veryfast", "-crf", "23"],
+}
+# Декодирование на GPU; кадры возвращаются в RAM, т.к. eq/unsharp/overlay/drawtext — CPU-фильтры
+VIDEO_DECODER_ARGS = {
+    "h264_nvenc": ["-hwaccel", "cuda"],
+}
+# Одновременных сессий аппаратного кодера на процесс: каждая ветка пакетного ffmpeg — своя сессия,
+# а потребительские NVENC допускают 5–8 сессий на всю карту
+_hw_sessions = os.getenv("HW_ENCODE_SESSIONS", "4")
+HW_ENCODE_SESSIONS = max(1, int(_hw_sessions)) if (_hw_sessions and _hw_sessions.strip().isdigit()) else 4
+_hw_sessions_cond = threading.Condition()
+_hw_sessions_used = 0
+
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ====================
 
+def fast_tmp_dir(min_free_bytes: int = 0) -> Optional[str]:
+    """
+    Каталог для tempfile на tmpfs (FAST_TMP, по умолчанию /dev/shm), если он есть и свободно больше min_free_bytes
+    (за вычетом места, зарезервированного через reserve_fast_tmp). Иначе None — tempfile возьмёт системный tmp на диске.
+    """
+    if not FAST_TMP or not os.path.isdir(FAST_TMP):
+        return None
+    try:
+        free = shutil.disk_usage(FAST_TMP).free
+    except OSError:
+        return None
+    return FAST_TMP if free - _fast_tmp_reserved > min_free_bytes else None
+
+
+@contextmanager
+def reserve_fast_tmp(nbytes: int) -> Iterator[Optional[str]]:
+    """
+    Как fast_tmp_dir(nbytes), но на время with резервирует nbytes: параллельные задачи
+    не выбирают tmpfs, рассчитывая на одно и то же свободное место.
+    """
+    global _fast_tmp_reserved
+    with _fast_tmp_lock:
+        tmp_dir = fast_tmp_dir(nbytes)
+        if tmp_dir:
+            _fast_tmp_reserved += nbytes
+    try:
+        yield tmp_dir
+    finally:
+        if tmp_dir:
+            with _fast_tmp_lock:
+                _fast_tmp_reserved -= nbytes
+
+
+def _part_path(p: Path) -> Path:
+    """
+    Временное имя на время кодирования: output_path появляется только целиком (важно для skip_if_exists).
+    Уникально на процесс и вызов — параллельные кодирования одного output_path не пишут в один файл.
+    """
+    return p.with_name(f"{p.stem}.{os.getpid()}.{uuid.uuid4().hex[:8]}.part{p.suffix}")
+
+
 def _overlay_expr(pos: str, margin: int) -> str:
     return {
         "tl": f"{margin}:{margin}",
@@ -56,30 +135,136 @@ def _ff_escape_path(p: Path) -> str:
     return str(p.resolve().as_posix()).replace(":", r"\:")
 
 
-def _has_audio_stream(src: Path) -> bool:
+def probe_video_file(src: Path) -> dict:
+    """
+    Один вызов ffprobe на файл: {has_audio, width, height, duration}.
+    Не зависит от params — можно посчитать 1 раз на входное видео и переиспользовать для всех user-ов.
+    """
     cmd = [
         "ffprobe", "-v", "error",
-        "-select_streams", "a:0",
-        "-show_entries", "stream=codec_type",
-        "-of", "csv=p=0", str(src)
+        "-show_entries", "stream=codec_type,width,height:format=duration",
+        "-of", "json", str(src)
     ]
+    info = {"has_audio": False, "width": None, "height": None, "duration": None}
     p = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8", errors="replace")
-    return p.returncode == 0 and "audio" in (p.stdout or "").lower()
+    if p.returncode != 0:
+        return info
+    try:
+        data = json.loads(p.stdout or "{}")
+    except ValueError:
+        return info
+
+    for st in data.get("streams") or []:
+        kind = st.get("codec_type")
+        if kind == "audio":
+            info["has_audio"] = True
+        elif kind == "video" and info["width"] is None:
+            info["width"] = st.get("width")
+            info["height"] = st.get("height")
+    try:
+        info["duration"] = float((data.get("format") or {}).get("duration"))
+    except (TypeError, ValueError):
+        pass
+    return info
+
+
+def _has_audio_stream(src: Path) -> bool:
+    return probe_video_file(src)["has_audio"]
 
 
 def _run(cmd_list: list[str]) -> subprocess.CompletedProcess:
     return subprocess.run(cmd_list, capture_output=True, text=True, encoding="utf-8", errors="replace")
 
 
-def _stderr_has_rubberband_issue(stderr: str) -> bool:
-    s = (stderr or "").lower()
-    # типовые сообщения ffmpeg
-    return ("rubberband" in s) and (
-        ("no such filter" in s) or
-        ("filter not found" in s) or
-        ("invalid argument" in s) or
-        ("error initializing filter" in s)
-    )
+class _ProcessStdout:
+    """
+    stdout ffmpeg для потоковой отдачи: на EOF дожидается процесса и при ненулевом коде
+    поднимает RuntimeError из read() — читатель не примет обрезанный вывод (падение/OOM/ENOSPC) за конец видео.
+    """
+
+    def __init__(self, proc: subprocess.Popen, log_path: Path):
+        self._proc = proc
+        self._log_path = log_path
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._proc.stdout.read(size)
+        if not chunk:
+            self._proc.wait()
+            if self._proc.returncode != 0:
+                err = self._log_path.read_text(encoding="utf-8", errors="replace")
+                raise RuntimeError(f"ffmpeg error: {err or 'unknown'}")
+        return chunk
+
+
+def _encoder_works(encoder: str) -> bool:
+    """Пробное кодирование 1 кадра: энкодер может быть в сборке ffmpeg, но без GPU/драйвера."""
+    cmd = [
+        "ffmpeg", "-hide_banner", "-v", "error",
+        "-f", "lavfi", "-i", "color=s=256x256:d=0.1", "-frames:v", "1",
+        *VIDEO_ENCODER_ARGS[encoder],
+        "-f", "null", "-",
+    ]
+    try:
+        return _run(cmd).returncode == 0
+    except OSError:
+        return False
+
+
+@lru_cache(maxsize=1)
+def _pick_video_encoder() -> str:
+    """Определяется 1 раз на процесс: h264_nvenc > h264_qsv > h264_videotoolbox > libx264."""
+    if FORCE_SW_ENCODE:
+        return "libx264"
+    try:
+        listed = _run(["ffmpeg", "-hide_banner", "-encoders"]).stdout or ""
+    except OSError:
+        return "libx264"
+    for encoder in HW_ENCODERS:
+        if f" {encoder} " in listed and _encoder_works(encoder):
+            return encoder
+    return "libx264"
+
+
+@contextmanager
+def _encoder_sessions(encoder: str, n: int) -> Iterator[None]:
+    """Для аппаратного кодера ждёт, пока освободятся n сессий из HW_ENCODE_SESSIONS; libx264 не ограничен."""
+    global _hw_sessions_used
+    if encoder == "libx264":
+        yield
+        return
+    n = min(n, HW_ENCODE_SESSIONS)
+    with _hw_sessions_cond:
+        _hw_sessions_cond.wait_for(lambda: _hw_sessions_used + n <= HW_ENCODE_SESSIONS)
+        _hw_sessions_used += n
+    try:
+        yield
+    finally:
+        with _hw_sessions_cond:
+            _hw_sessions_used -= n
+            _hw_sessions_cond.notify_all()
+
+
+def _run_encode(build_cmd: Callable[[str], list[str]], sessions: int) -> subprocess.CompletedProcess:
+    """
+    ffmpeg с выбранным кодером; аппаратный — под лимитом HW_ENCODE_SESSIONS (sessions — число его выходов).
+    Если аппаратный не справился (сессии заняты другими процессами, сбой драйвера) — повтор на libx264.
+    """
+    encoder = _pick_video_encoder()
+    with _encoder_sessions(encoder, sessions):
+        p = _run(build_cmd(encoder))
+    if p.returncode != 0 and encoder != "libx264":
+        p = _run(build_cmd("libx264"))
+    return p
+
+
+@lru_cache(maxsize=1)
+def _rubberband_available() -> bool:
+    """Есть ли фильтр rubberband в ffmpeg. Проверяется 1 раз на процесс, вместо заведомо падающего прогона."""
+    try:
+        listed = _run(["ffmpeg", "-hide_banner", "-filters"]).stdout or ""
+    except OSError:
+        return False
+    return " rubberband " in listed
 
 
 def _pick_params(rng: random.Random) -> dict:
@@ -108,6 +293,10 @@ def _pick_params(rng: random.Random) -> dict:
     eqg = round(rng.uniform(*AUDIO_EQ_GAIN_RANGE), 2)
     pitch = round(rng.uniform(*AUDIO_PITCH_RANGE), 4)
 
+    # позиция окна кропа (0..1 от свободного поля); в конце — чтобы не сдвигать прежние параметры seed-а
+    crop_x = round(rng.uniform(0, 1), 3)
+    crop_y = round(rng.uniform(0, 1), 3)
+
     return {
         "speed": speed,
         "brightness": brightness,
@@ -127,25 +316,30 @@ def _pick_params(rng: random.Random) -> dict:
         "eqf": eqf,
         "eqg": eqg,
         "pitch": pitch,
+        "crop_x": crop_x,
+        "crop_y": crop_y,
     }
 
 
-def _build_cmd(
+def _build_filter_graph(
     *,
-    inp_path: Path,
-    out_path: Path,
+    vin: str,
+    ain: str,
+    logo_in: Optional[str],
     params: dict,
-    logo_path: Optional[Path],
     overlay_text: Optional[str],
     font_path: Optional[Path],
     audio_enabled: bool,
     audio_present: bool,
     use_rubberband: bool,
     td_path: Path,  # для text.txt
-) -> Tuple[list[str], list[str], str]:
+    tag: str = "",
+) -> Tuple[list[str], str, Optional[str]]:
     """
-    Возвращает (cmd, fc_parts, filter_complex)
-    fc_parts возвращаем, чтобы при надобности можно было дебажить.
+    Части filter_complex для одной уникальной версии.
+    vin/ain/logo_in — метки входов (например "0:v" или выход split); tag — суффикс меток,
+    чтобы несколько версий уживались в одном графе.
+    Возвращает (fc_parts, метка видео-выхода, метка аудио-выхода или None).
     """
     speed = params["speed"]
     brightness = params["brightness"]
@@ -154,7 +348,8 @@ def _build_cmd(
 
     vf_chain = [
         f"setpts=PTS/{speed}",
-        "scale=iw*1.01:ih*1.01,crop=iw/1.01:ih/1.01:(iw-iw/1.01)/2:(ih-ih/1.01)/2",
+        # один проход кропа вместо scale x1.01 + crop обратно; размеры чётные для yuv420p
+        f"crop=floor(iw*{CROP_KEEP}/2)*2:floor(ih*{CROP_KEEP}/2)*2:(iw-ow)*{params['crop_x']}:(ih-oh)*{params['crop_y']}",
         f"eq=brightness={brightness}:contrast={contrast}:saturation={saturation}",
     ]
 
@@ -162,15 +357,15 @@ def _build_cmd(
         vf_chain.append(f"unsharp=5:5:{params['sharpen_strength']}:5:5:0.0")
     base_vf = ",".join(vf_chain)
 
-    inputs = ["-i", str(inp_path)]
-    fc_parts = [f"[0:v]{base_vf}[v0]"]
-    vcur = "v0"
+    fc_parts = [f"[{vin}]{base_vf}[v0{tag}]"]
+    vcur = f"v0{tag}"
 
-    if logo_path and logo_path.is_file():
-        inputs += ["-i", str(logo_path)]
-        fc_parts.append(f"[1:v]scale=-1:{params['logo_height']}[logo]")
-        fc_parts.append(f"[{vcur}][logo]overlay={_overlay_expr(params['logo_pos'], params['logo_margin'])}[v1]")
-        vcur = "v1"
+    if logo_in:
+        fc_parts.append(f"[{logo_in}]scale=-1:{params['logo_height']}[logo{tag}]")
+        fc_parts.append(
+            f"[{vcur}][logo{tag}]overlay={_overlay_expr(params['logo_pos'], params['logo_margin'])}[v1{tag}]"
+        )
+        vcur = f"v1{tag}"
 
     # текст
     if overlay_text and font_path and font_path.is_file():
@@ -180,11 +375,12 @@ def _build_cmd(
         textfile = _ff_escape_path(textfile_path)
         fc_parts.append(
             f"[{vcur}]drawtext=fontfile='{fontfile}':textfile='{textfile}':reload=0:"
-            f"fontsize={params['text_size']}:fontcolor=white:x=w-tw-{params['text_margin']}:y=h-th-{params['text_margin']}[vout]"
+            f"fontsize={params['text_size']}:fontcolor=white:x=w-tw-{params['text_margin']}:y=h-th-{params['text_margin']}[vout{tag}]"
         )
-        vcur = "vout"
+        vcur = f"vout{tag}"
 
     # аудио
+    acur = None
     if audio_enabled and audio_present:
         af_chain = [
             f"atempo={speed}",
@@ -195,34 +391,163 @@ def _build_cmd(
         ]
         if use_rubberband:
             af_chain.append(f"rubberband=pitch={params['pitch']}")
-        fc_parts.append(f"[0:a]{','.join(af_chain)}[aout]")
+        fc_parts.append(f"[{ain}]{','.join(af_chain)}[aout{tag}]")
+        acur = f"aout{tag}"
+
+    return fc_parts, vcur, acur
 
-    filter_complex = ";".join(fc_parts)
 
-    meta_args: list[str] = []
+def _thread_args(threads: Optional[int]) -> list[str]:
+    """Глобальные опции потоков фильтров (eq/unsharp и т.п. работают кадро-параллельно)."""
+    n = threads or os.cpu_count() or 1
+    return ["-filter_threads", str(n), "-filter_complex_threads", str(n)]
+
+
+def _output_args(params: dict, encoder: str, vlabel: str, alabel: Optional[str]) -> list[str]:
+    """-map + кодеки + метадата для одного выхода (без имени файла)."""
     if params["meta_mode"] == "remove":
         meta_args = ["-map_metadata", "-1"]
     else:
         meta_args = ["-map_metadata", "-1", "-metadata", f"comment=proc_{random.randint(100000, 999999)}"]
 
+    args = ["-map", f"[{vlabel}]"]
+    if alabel:
+        args += ["-map", f"[{alabel}]"]
+    else:
+        args += ["-map", "0:a?"]
+
+    return [
+        *args,
+        *VIDEO_ENCODER_ARGS[encoder],
+        "-threads", "0",
+        "-c:a", "aac", "-b:a", "160k",
+        *meta_args,
+    ]
+
+
+def _build_cmd(
+    *,
+    inp_path: Path,
+    out_path: Optional[Path],
+    params: dict,
+    logo_path: Optional[Path],
+    overlay_text: Optional[str],
+    font_path: Optional[Path],
+    audio_enabled: bool,
+    audio_present: bool,
+    use_rubberband: bool,
+    td_path: Path,  # для text.txt
+    to_pipe: bool = False,
+    threads: Optional[int] = None,
+    encoder: Optional[str] = None,
+) -> Tuple[list[str], list[str], str]:
+    """
+    Возвращает (cmd, fc_parts, filter_complex)
+    fc_parts возвращаем, чтобы при надобности можно было дебажить.
+    to_pipe=True — вывод в stdout (pipe:1); если при этом задан out_path, поток дублируется в файл через tee.
+    encoder — по умолчанию _pick_video_encoder().
+    """
+    encoder = encoder or _pick_video_encoder()
+    inputs = [*VIDEO_DECODER_ARGS.get(encoder, []), "-i", str(inp_path)]
+    has_logo = bool(logo_path and logo_path.is_file())
+    if has_logo:
+        inputs += ["-i", str(logo_path)]
+
+    fc_parts, vcur, acur = _build_filter_graph(
+        vin="0:v",
+        ain="0:a",
+        logo_in="1:v" if has_logo else None,
+        params=params,
+        overlay_text=overlay_text,
+        font_path=font_path,
+        audio_enabled=audio_enabled,
+        audio_present=audio_present,
+        use_rubberband=use_rubberband,
+        td_path=td_path,
+    )
+    filter_complex = ";".join(fc_parts)
+
     cmd: list[str] = [
         "ffmpeg", "-y",
+        *_thread_args(threads),
         *inputs,
         "-filter_complex", filter_complex,
-        "-map", f"[{vcur}]",
+        *_output_args(params, encoder, vcur, acur),
     ]
-    if audio_enabled and audio_present:
-        cmd += ["-map", "[aout]"]
+    if not to_pipe:
+        cmd.append(str(out_path))
+    elif out_path is None:
+        cmd += ["-movflags", PIPE_MOVFLAGS, "-f", "mp4", "pipe:1"]
     else:
-        cmd += ["-map", "0:a?"]
+        # tee не сообщает кодерам, что mp4 нужен global header (avcC) — просим явно
+        cmd += [
+            "-flags", "+global_header",
+            "-f", "tee",
+            f"[f=mp4:movflags=+faststart]{out_path.as_posix()}|[f=mp4:movflags={PIPE_MOVFLAGS}:onfail=ignore]pipe:1",
+        ]
+    return cmd, fc_parts, filter_complex
 
-    cmd += [
-        "-c:v", "libx264", "-preset", "veryfast", "-crf", "23",
-        "-c:a", "aac", "-b:a", "160k",
-        *meta_args,
-        str(out_path),
+
+def _build_multi_cmd(
+    *,
+    inp_path: Path,
+    jobs: list[Tuple[Path, dict]],
+    logo_path: Optional[Path],
+    overlay_text: Optional[str],
+    font_path: Optional[Path],
+    audio_enabled: bool,
+    audio_present: bool,
+    use_rubberband: bool,
+    td_path: Path,  # для text.txt
+    threads: Optional[int] = None,
+    encoder: Optional[str] = None,
+) -> Tuple[list[str], str]:
+    """
+    Одна команда ffmpeg на несколько уникальных версий: вход декодируется 1 раз,
+    split/asplit раздают кадры веткам, у каждой ветки свои params и свой выходной файл.
+    jobs — [(out_path, params), ...]. Возвращает (cmd, filter_complex).
+    """
+    encoder = encoder or _pick_video_encoder()
+    inputs = [*VIDEO_DECODER_ARGS.get(encoder, []), "-i", str(inp_path)]
+    has_logo = bool(logo_path and logo_path.is_file())
+    if has_logo:
+        inputs += ["-i", str(logo_path)]
+    with_audio = audio_enabled and audio_present
+
+    n = len(jobs)
+    fc_parts = [f"[0:v]split={n}" + "".join(f"[vin{i}]" for i in range(n))]
+    if has_logo:
+        fc_parts.append(f"[1:v]split={n}" + "".join(f"[login{i}]" for i in range(n)))
+    if with_audio:
+        fc_parts.append(f"[0:a]asplit={n}" + "".join(f"[ain{i}]" for i in range(n)))
+
+    outputs: list[str] = []
+    for i, (out_path, params) in enumerate(jobs):
+        parts, vcur, acur = _build_filter_graph(
+            vin=f"vin{i}",
+            ain=f"ain{i}",
+            logo_in=f"login{i}" if has_logo else None,
+            params=params,
+            overlay_text=overlay_text,
+            font_path=font_path,
+            audio_enabled=audio_enabled,
+            audio_present=audio_present,
+            use_rubberband=use_rubberband,
+            td_path=td_path,
+            tag=f"_{i}",
+        )
+        fc_parts += parts
+        outputs += [*_output_args(params, encoder, vcur, acur), str(out_path)]
+
+    filter_complex = ";".join(fc_parts)
+    cmd: list[str] = [
+        "ffmpeg", "-y",
+        *_thread_args(threads),
+        *inputs,
+        "-filter_complex", filter_complex,
+        *outputs,
     ]
-    return cmd, fc_parts, filter_complex
+    return cmd, filter_complex
 
 
 # ==================== ПУБЛИЧНЫЙ API ====================
@@ -237,10 +562,14 @@ def uniquify_video_file(
     overlay_text: Optional[str] = None,
     font_path: Optional[Path] = None,
     audio_enabled: bool = AUDIO_ENABLE_DEFAULT,
+    audio_present: Optional[bool] = None,
+    threads: Optional[int] = None,
 ) -> Path:
     """
     File-to-file уникализация: читает input_path, пишет output_path, возвращает output_path.
     Это основной серверный режим: меньше RAM, меньше копирований.
+    audio_present — результат probe_video_file(input_path); если None, ffprobe запускается здесь.
+    threads — потоки фильтров ffmpeg (по умолчанию все ядра); при нескольких ffmpeg одновременно стоит уменьшить.
     """
     input_path = Path(input_path)
     output_path = Path(output_path)
@@ -257,48 +586,184 @@ def uniquify_video_file(
     rng = random.Random(seed) if seed is not None else random
     params = _pick_params(rng)
 
-    audio_present = _has_audio_stream(input_path)
+    if audio_present is None:
+        audio_present = _has_audio_stream(input_path)
 
     # Временная директория только под text.txt (если надо).
-    with tempfile.TemporaryDirectory(prefix="vitrina_unique_") as td:
+    with tempfile.TemporaryDirectory(prefix="vitrina_unique_", dir=fast_tmp_dir()) as td:
         td_path = Path(td)
 
-        # 1) пробуем с rubberband (если включено)
-        use_rb = bool(USE_RUBBERBAND)
-        cmd, _, _ = _build_cmd(
+        part_path = _part_path(output_path)
+        p = _run_encode(lambda encoder: _build_cmd(
             inp_path=input_path,
-            out_path=output_path,
+            out_path=part_path,
             params=params,
             logo_path=Path(logo_path) if logo_path else None,
             overlay_text=overlay_text,
             font_path=Path(font_path) if font_path else None,
             audio_enabled=audio_enabled,
             audio_present=audio_present,
-            use_rubberband=use_rb,
+            use_rubberband=USE_RUBBERBAND and _rubberband_available(),
             td_path=td_path,
-        )
-        p = _run(cmd)
+            threads=threads,
+            encoder=encoder,
+        )[0], sessions=1)
+
+        if p.returncode != 0:
+            part_path.unlink(missing_ok=True)
+            raise RuntimeError(f"ffmpeg error: {p.stderr or p.stdout or 'unknown'}")
+        os.replace(part_path, output_path)
+
+    return output_path
+
+
+def uniquify_video_files(
+    input_path: Path,
+    jobs: list[Tuple[Path, Optional[int]]],
+    *,
+    skip_if_exists: bool = SKIP_IF_EXISTS,
+    logo_path: Optional[Path] = None,
+    overlay_text: Optional[str] = None,
+    font_path: Optional[Path] = None,
+    audio_enabled: bool = AUDIO_ENABLE_DEFAULT,
+    audio_present: Optional[bool] = None,
+    threads: Optional[int] = None,
+) -> list[Path]:
+    """
+    Несколько уникальных версий одного входа за один запуск ffmpeg (декодирование 1 раз на все версии).
+    jobs — [(output_path, seed), ...]; для каждой версии params те же, что дал бы uniquify_video_file с этим seed.
+    Возвращает список output_path в порядке jobs. Ошибка ffmpeg — RuntimeError сразу на все версии.
+    skip_if_exists — уже готовые output_path не кодируются повторно; если готовы все, ffmpeg не запускается.
+    """
+    input_path = Path(input_path)
+    outputs = [Path(out) for out, _ in jobs]
+    if skip_if_exists:
+        jobs = [(out, seed) for out, seed in jobs if not Path(out).is_file()]
+    if not jobs:
+        return outputs
+
+    if not font_path:
+        fp = Path(__file__).parent / "Arial.ttf"
+        font_path = fp if fp.is_file() else None
 
-        # 2) если rubberband недоступен — повторяем без него
-        if p.returncode != 0 and use_rb and audio_enabled and audio_present and _stderr_has_rubberband_issue(p.stderr):
-            cmd2, _, _ = _build_cmd(
+    planned: list[Tuple[Path, dict]] = []
+    for output_path, seed in jobs:
+        output_path = Path(output_path)
+        # Одинаковый output_path (тот же seed) — одна версия, кодируется 1 раз
+        if any(out == output_path for out, _ in planned):
+            continue
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        rng = random.Random(seed) if seed is not None else random
+        planned.append((output_path, _pick_params(rng)))
+
+    if audio_present is None:
+        audio_present = _has_audio_stream(input_path)
+
+    # Каждый выход аппаратного кодера — своя сессия: ffmpeg получает не больше HW_ENCODE_SESSIONS версий
+    step = len(planned) if _pick_video_encoder() == "libx264" else HW_ENCODE_SESSIONS
+
+    # Временная директория только под text.txt (если надо).
+    with tempfile.TemporaryDirectory(prefix="vitrina_unique_", dir=fast_tmp_dir()) as td:
+        td_path = Path(td)
+        for i in range(0, len(planned), step):
+            chunk = planned[i:i + step]
+            parts = [(_part_path(out), params) for out, params in chunk]
+            p = _run_encode(lambda encoder: _build_multi_cmd(
                 inp_path=input_path,
-                out_path=output_path,
-                params=params,
+                jobs=parts,
                 logo_path=Path(logo_path) if logo_path else None,
                 overlay_text=overlay_text,
                 font_path=Path(font_path) if font_path else None,
                 audio_enabled=audio_enabled,
                 audio_present=audio_present,
-                use_rubberband=False,
+                use_rubberband=USE_RUBBERBAND and _rubberband_available(),
                 td_path=td_path,
-            )
-            p = _run(cmd2)
+                threads=threads,
+                encoder=encoder,
+            )[0], sessions=len(parts))
 
-        if p.returncode != 0:
-            raise RuntimeError(f"ffmpeg error: {p.stderr or p.stdout or 'unknown'}")
+            if p.returncode != 0:
+                for part_path, _ in parts:
+                    part_path.unlink(missing_ok=True)
+                raise RuntimeError(f"ffmpeg error: {p.stderr or p.stdout or 'unknown'}")
+            for (part_path, _), (out, _) in zip(parts, chunk):
+                os.replace(part_path, out)
 
-    return output_path
+    return outputs
+
+
+@contextmanager
+def uniquify_video_stream(
+    input_path: Path,
+    output_path: Optional[Path] = None,
+    *,
+    seed: Optional[int] = None,
+    logo_path: Optional[Path] = None,
+    overlay_text: Optional[str] = None,
+    font_path: Optional[Path] = None,
+    audio_enabled: bool = AUDIO_ENABLE_DEFAULT,
+    audio_present: Optional[bool] = None,
+    threads: Optional[int] = None,
+) -> Iterator[IO[bytes]]:
+    """
+    Потоковая уникализация: ffmpeg пишет фрагментированный mp4 в stdout, и его можно
+    отдавать в сеть, не дожидаясь конца кодирования.
+    Если задан output_path — тот же поток параллельно пишется в файл (tee) для повторного использования.
+    Ошибка ffmpeg поднимается как RuntimeError из read() на EOF (до того, как читатель
+    сочтёт поток законченным) и ещё раз при выходе из with.
+    """
+    input_path = Path(input_path)
+    output_path = Path(output_path) if output_path else None
+
+    if not font_path:
+        fp = Path(__file__).parent / "Arial.ttf"
+        font_path = fp if fp.is_file() else None
+
+    if output_path:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    rng = random.Random(seed) if seed is not None else random
+    params = _pick_params(rng)
+
+    if audio_present is None:
+        audio_present = _has_audio_stream(input_path)
+
+    # Временная директория под text.txt и лог ffmpeg (stderr нельзя оставлять в pipe — заблокирует процесс).
+    # Повтора на libx264 здесь нет — байты уже ушли читателю; сессия кодера держится, пока идёт поток.
+    encoder = _pick_video_encoder()
+    with tempfile.TemporaryDirectory(prefix="vitrina_unique_", dir=fast_tmp_dir()) as td, \
+            _encoder_sessions(encoder, 1):
+        td_path = Path(td)
+        cmd, _, _ = _build_cmd(
+            inp_path=input_path,
+            out_path=output_path,
+            params=params,
+            logo_path=Path(logo_path) if logo_path else None,
+            overlay_text=overlay_text,
+            font_path=Path(font_path) if font_path else None,
+            audio_enabled=audio_enabled,
+            audio_present=audio_present,
+            use_rubberband=USE_RUBBERBAND and _rubberband_available(),
+            td_path=td_path,
+            to_pipe=True,
+            threads=threads,
+            encoder=encoder,
+        )
+        log_path = td_path / "ffmpeg.log"
+        with open(log_path, "wb") as log:
+            proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=log)
+            try:
+                yield _ProcessStdout(proc, log_path)
+            except BaseException:
+                proc.kill()
+                raise
+            finally:
+                proc.stdout.close()
+                proc.wait()
+
+        if proc.returncode != 0:
+            err = log_path.read_text(encoding="utf-8", errors="replace")
+            raise RuntimeError(f"ffmpeg error: {err or 'unknown'}")
 
 
 def uniquify_video(
@@ -316,7 +781,9 @@ def uniquify_video(
     Bytes->bytes обёртка поверх file-to-file.
     Удобно для API/старого кода, но расходует больше RAM/IO.
     """
-    with tempfile.TemporaryDirectory(prefix="vitrina_unique_bytes_") as td:
+    # вход + выход в tmp
+    with reserve_fast_tmp(2 * len(input_bytes)) as tmp_dir, \
+            tempfile.TemporaryDirectory(prefix="vitrina_unique_bytes_", dir=tmp_dir) as td:
         td_path = Path(td)
         inp_path = td_path / "in.mp4"
         inp_path.write_bytes(input_bytes)